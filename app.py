@@ -1,20 +1,37 @@
 import os
 import json
+import queue
+import asyncio
 import time
 import logging
-import hashlib
-from typing import Optional
+import threading
+from typing import AsyncIterator, List, Optional, Tuple
+from uuid import uuid4
+import msgspec
+from cachetools import TTLCache, cached
+
+# Must be set before CUDA initializes; expandable segments limit fragmentation
+# from variable-length prompts
+os.environ.setdefault("PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512")
+
 import torch
-import redis
+import xxhash
+import redis.asyncio as redis
+from accelerate import init_empty_weights
 from transformers import (
+    AutoConfig,
     AutoTokenizer, 
     AutoModelForCausalLM, 
     BitsAndBytesConfig,
-    pipeline
+    StaticCache,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer
 )
-from fastapi import FastAPI, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, Field
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing_extensions import Annotated
+from pydantic import BaseModel, ConfigDict, Field
 import uvicorn
 
 # Configure logging
@@ -28,12 +45,14 @@ app = FastAPI(
 )
 
 class GenerationRequest(BaseModel):
-    prompt: str = Field(..., min_length=1, max_length=2000)
-    max_new_tokens: int = Field(default=100, ge=1, le=500)
-    temperature: float = Field(default=0.7, ge=0.1, le=2.0)
-    top_p: float = Field(default=0.9, ge=0.1, le=1.0)
-    do_sample: bool = Field(default=True)
-    stream: bool = Field(default=False)
+    model_config = ConfigDict(extra='forbid')
+
+    prompt: Annotated[str, Field(min_length=1, max_length=2000)]
+    max_new_tokens: Annotated[int, Field(ge=1, le=500)] = 100
+    temperature: Annotated[float, Field(ge=0.1, le=2.0)] = 0.7
+    top_p: Annotated[float, Field(ge=0.1, le=1.0)] = 0.9
+    do_sample: bool = True
+    stream: bool = False
 
 class GenerationResponse(BaseModel):
     prompt: str
@@ -43,45 +62,103 @@ class GenerationResponse(BaseModel):
     cached: bool
     tokens_generated: int
 
-# Initialize Redis
+# Redis is connected during startup so the ping can be awaited
 redis_client = None
-try:
-    redis_url = os.getenv('CACHE_URL')
-    if redis_url:
-        redis_client = redis.from_url(redis_url, decode_responses=True)
-        redis_client.ping()
-        logger.info("Redis cache connected")
-except Exception as e:
-    logger.warning(f"Redis not available: {e}")
+cache_encoder = msgspec.msgpack.Encoder()
+cache_decoder = msgspec.msgpack.Decoder(dict)
+CACHE_TTL = 3600
+# Keep references to fire-and-forget cache writes so they aren't garbage collected
+cache_write_tasks = set()
+
+# Hot responses are served from process memory before going to Redis
+local_cache = TTLCache(maxsize=int(os.getenv('LOCAL_CACHE_SIZE', '1024')), ttl=CACHE_TTL)
 
 MODEL_NAME = os.getenv('MODEL_NAME', 'microsoft/DialoGPT-medium')
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+GPU_NAME = torch.cuda.get_device_name(0) if DEVICE == "cuda" else None
 MAX_MEMORY_GB = int(os.getenv('MAX_MEMORY_GB', '12'))
+INFERENCE_BACKEND = os.getenv('INFERENCE_BACKEND', 'transformers')
+VLLM_QUANTIZATION = os.getenv('VLLM_QUANTIZATION', 'awq')
+GPU_MEMORY_UTILIZATION = float(os.getenv('GPU_MEMORY_UTILIZATION', '0.9'))
+ENABLE_PREFIX_CACHING = os.getenv('ENABLE_PREFIX_CACHING', 'true').lower() == 'true'
+QUANTIZATION = os.getenv('QUANTIZATION', 'auto')
+QUANTIZATION_OPTIONS = ("auto", "fp16", "int8", "nf4")
+COMPILE_MODEL = os.getenv('COMPILE_MODEL', 'true').lower() == 'true'
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', '8'))
+BATCH_WAIT_MS = float(os.getenv('BATCH_WAIT_MS', '5'))
+MAX_CONCURRENCY = int(os.getenv('MAX_CONCURRENCY', str(MAX_BATCH_SIZE)))
+ADMISSION_TIMEOUT = 0.05
+STREAM_TOKEN_TIMEOUT = float(os.getenv('STREAM_TOKEN_TIMEOUT', '120'))
+# With static KV caches, prompts are padded up to one of these lengths so the compiled
+# prefill only ever sees a few input shapes
+PROMPT_BUCKETS = (128, 256, 512, 1024, 2048)
+# Prompt token budget when static KV caches are preallocated; byte-level BPE can
+# encode one character as several tokens, so this is checked separately from the
+# 2000-character request limit
+MAX_PROMPT_TOKENS = PROMPT_BUCKETS[-1]
+# Prompt cap plus the 500 max_new_tokens cap, so one static cache fits every request
+STATIC_CACHE_LEN = MAX_PROMPT_TOKENS + 500
+
+# Prompt shapes vary per request, so cuDNN autotuning would never pay off
+torch.backends.cudnn.benchmark = False
+# TF32 matmuls on Ampere and newer; no effect on older GPUs such as the T4
+torch.backends.cuda.matmul.allow_tf32 = True
 
 tokenizer = None
 model = None
-text_generator = None
+eos_token_id = None
+compiled_generate_lock = None
+static_caches = None
+engine = None
+batch_queue = None
+batch_worker_task = None
+generation_semaphore = None
+
+def select_quantization() -> str:
+    """Pick fp16 when the weights fit comfortably on the GPU, NF4 otherwise"""
+    if QUANTIZATION != "auto":
+        return QUANTIZATION
+
+    # Size the fp16 weights without allocating them
+    config = AutoConfig.from_pretrained(MODEL_NAME, cache_dir='/tmp/.transformers')
+    with init_empty_weights():
+        empty_model = AutoModelForCausalLM.from_config(config)
+    fp16_gb = empty_model.num_parameters() * 2 / 1024**3
+
+    gpu_gb = min(torch.cuda.get_device_properties(0).total_memory / 1024**3, MAX_MEMORY_GB)
+
+    # Leave headroom for activations and the KV cache
+    return "fp16" if fp16_gb <= gpu_gb * 0.6 else "nf4"
 
 def initialize_model():
     """Initialize and load the LLM model"""
-    global tokenizer, model, text_generator
+    global tokenizer, model, eos_token_id, compiled_generate_lock, static_caches
 
     logger.info(f"Initializing model {MODEL_NAME} on {DEVICE}")
 
-    if torch.cuda.is_available():
-        gpu_name = torch.cuda.get_device_name(0)
+    if QUANTIZATION not in QUANTIZATION_OPTIONS:
+        raise ValueError(
+            f"Unsupported QUANTIZATION={QUANTIZATION!r}; expected one of {', '.join(QUANTIZATION_OPTIONS)}"
+        )
+
+    if DEVICE == "cuda":
         gpu_memory = torch.cuda.get_device_properties(0).total_memory / 1024**3
-        logger.info(f"GPU: {gpu_name}, Memory: {gpu_memory:.1f}GB")
+        logger.info(f"GPU: {GPU_NAME}, Memory: {gpu_memory:.1f}GB")
 
     try:
         tokenizer = AutoTokenizer.from_pretrained(
             MODEL_NAME,
+            use_fast=True,
             padding_side='left',
             cache_dir='/tmp/.transformers'
         )
 
+        if not tokenizer.is_fast:
+            logger.warning(f"No fast (Rust) tokenizer available for {MODEL_NAME}; using the slow Python tokenizer")
+
         if tokenizer.pad_token is None:
             tokenizer.pad_token = tokenizer.eos_token
+        eos_token_id = tokenizer.eos_token_id
 
         model_kwargs = {
             "cache_dir": '/tmp/.transformers',
@@ -89,23 +166,83 @@ def initialize_model():
         }
 
         if DEVICE == "cuda":
-            model_kwargs["quantization_config"] = BitsAndBytesConfig(
-                load_in_8bit=True,
-                llm_int8_enable_fp32_cpu_offload=True
-            )
+            model_kwargs["device_map"] = "auto"
+            model_kwargs["max_memory"] = {0: f"{MAX_MEMORY_GB}GiB"}
+
+            quantization = select_quantization()
+            logger.info(f"Weight format: {quantization}")
+
+            if quantization == "nf4":
+                model_kwargs["quantization_config"] = BitsAndBytesConfig(
+                    load_in_4bit=True,
+                    bnb_4bit_quant_type="nf4",
+                    bnb_4bit_use_double_quant=True,
+                    bnb_4bit_compute_dtype=torch.float16
+                )
+            elif quantization == "int8":
+                # Quantize once at load and keep int8 weights resident on the GPU
+                model_kwargs["quantization_config"] = BitsAndBytesConfig(
+                    load_in_8bit=True,
+                    llm_int8_enable_fp32_cpu_offload=False,
+                    llm_int8_has_fp16_weight=False,
+                    llm_int8_threshold=6.0
+                )
 
         model = AutoModelForCausalLM.from_pretrained(
             MODEL_NAME,
             **model_kwargs
         )
 
-        # Do NOT pass device= when using Accelerate or quantized models
-        text_generator = pipeline(
-            "text-generation",
-            model=model,
-            tokenizer=tokenizer,
-            torch_dtype=torch.float16 if DEVICE == "cuda" else torch.float32
-        )
+        if DEVICE == "cuda":
+            # CPU/disk offload round-trips weights over PCIe per token; fail fast instead
+            offloaded = {
+                name: device for name, device in getattr(model, "hf_device_map", {}).items()
+                if device in ("cpu", "disk")
+            }
+            if offloaded:
+                raise RuntimeError(
+                    f"Model does not fit in {MAX_MEMORY_GB}GB of GPU memory "
+                    f"({len(offloaded)} modules offloaded); use QUANTIZATION=nf4 or a larger GPU"
+                )
+
+            # bitsandbytes kernels do not trace under torch.compile, so only compile fp16.
+            # With a dynamic KV cache the sequence length changes every decode step and
+            # CUDA graphs would be re-recorded per shape, so compilation also needs a
+            # static cache.
+            if COMPILE_MODEL and quantization == "fp16":
+                if getattr(model, "_supports_static_cache", False):
+                    # A fixed-shape KV cache lets the compiled decode step run as a CUDA graph.
+                    # Allocate one per shape generate is called with, padded batches and
+                    # single-sequence streams, and reuse them for every request.
+                    static_caches = {
+                        batch_size: StaticCache(
+                            config=model.config,
+                            max_batch_size=batch_size,
+                            max_cache_len=STATIC_CACHE_LEN,
+                            device=model.device,
+                            dtype=torch.float16
+                        )
+                        for batch_size in {MAX_BATCH_SIZE, 1}
+                    }
+
+                    # Room for a prefill graph per prompt bucket plus the decode graph, per batch shape
+                    torch._dynamo.config.cache_size_limit = max(
+                        torch._dynamo.config.cache_size_limit, 2 * (len(PROMPT_BUCKETS) + 1)
+                    )
+
+                    # generate() calls forward directly, so compile forward rather than the module
+                    model.forward = torch.compile(model.forward, mode="reduce-overhead", fullgraph=False)
+
+                    # Compiled graphs and the static cache are shared state; calls must not overlap
+                    compiled_generate_lock = threading.Lock()
+                    logger.info("Model forward compiled with torch.compile using a static KV cache")
+                else:
+                    logger.info(
+                        f"{model.__class__.__name__} does not support a static KV cache; "
+                        "skipping torch.compile"
+                    )
+
+        warmup_model()
 
         logger.info("Model initialized successfully")
 
@@ -113,30 +250,443 @@ def initialize_model():
         logger.error(f"Model initialization failed: {e}")
         raise
 
-def get_cache_key(prompt: str, params: dict) -> str:
-    cache_data = f"{prompt}:{json.dumps(params, sort_keys=True)}"
-    return f"llm:{hashlib.md5(cache_data.encode()).hexdigest()}"
+def warmup_model():
+    """Run dummy generations so the first request doesn't pay CUDA init and compile costs"""
+    start = time.time()
+    warmup_request = GenerationRequest(prompt="warmup", max_new_tokens=8, do_sample=False)
+    gen_args = get_generation_args(warmup_request)
+
+    try:
+        # The first pass compiles and captures graphs; the second runs the captured ones
+        for _ in range(2):
+            if static_caches is None:
+                generate_batch([warmup_request.prompt], gen_args, [warmup_request.max_new_tokens])
+                continue
+
+            # Cover every prefill bucket at both cache shapes: padded batches and streams
+            for batch_size in static_caches:
+                for prompt_length in PROMPT_BUCKETS:
+                    inputs = encode_prompts([warmup_request.prompt] * batch_size, prompt_length)
+                    run_generate(**inputs, **gen_args)
+
+    except torch.cuda.OutOfMemoryError as e:
+        # Memory pressure is the one transient failure; anything else is a bug and fails startup
+        logger.warning(f"Model warmup ran out of GPU memory: {e}")
+        return
+
+    logger.info(f"Model warmed up in {time.time() - start:.2f}s")
+
+def initialize_vllm_engine():
+    """Initialize a vLLM engine serving a pre-quantized (AWQ/GPTQ) checkpoint"""
+    global engine
+
+    # vLLM is optional and only required when INFERENCE_BACKEND=vllm
+    from vllm import AsyncEngineArgs, AsyncLLMEngine
+
+    logger.info(f"Initializing vLLM engine for {MODEL_NAME} (quantization: {VLLM_QUANTIZATION or 'none'})")
+
+    try:
+        engine_args = AsyncEngineArgs(
+            model=MODEL_NAME,
+            quantization=VLLM_QUANTIZATION or None,
+            dtype="float16",
+            gpu_memory_utilization=GPU_MEMORY_UTILIZATION,
+            # Reuse KV blocks across prompts that share a prefix (e.g. system prompts)
+            enable_prefix_caching=ENABLE_PREFIX_CACHING,
+            block_size=16,
+            download_dir='/tmp/.transformers'
+        )
+        engine = AsyncLLMEngine.from_engine_args(engine_args)
+
+        logger.info("vLLM engine initialized successfully")
+
+    except Exception as e:
+        logger.error(f"vLLM engine initialization failed: {e}")
+        raise
+
+def model_ready() -> bool:
+    if INFERENCE_BACKEND == "vllm":
+        return engine is not None
+    return model is not None and tokenizer is not None
+
+def get_generation_args(request: GenerationRequest) -> dict:
+    return {
+        "max_new_tokens": request.max_new_tokens,
+        "temperature": request.temperature,
+        "top_p": request.top_p,
+        "do_sample": request.do_sample,
+        "use_cache": True,
+        "pad_token_id": eos_token_id
+    }
+
+def run_generate(**kwargs) -> torch.Tensor:
+    # inference_mode skips autograd and view tracking entirely, unlike generate's own no_grad
+    if compiled_generate_lock is not None:
+        with compiled_generate_lock, torch.inference_mode():
+            cache = static_caches[kwargs["input_ids"].shape[0]]
+            cache.reset()
+            return model.generate(**kwargs, past_key_values=cache)
+
+    with torch.inference_mode():
+        return model.generate(**kwargs)
+
+def sampling_key(gen_args: dict) -> tuple:
+    """Settings that must be shared by every row of a batch"""
+    if not gen_args["do_sample"]:
+        # Greedy decoding ignores temperature and top_p
+        return (False,)
+    return (True, gen_args["temperature"], gen_args["top_p"])
+
+def encode_prompts(prompts: List[str], prompt_length: Optional[int] = None) -> dict:
+    if static_caches is None:
+        return tokenizer(prompts, return_tensors="pt", padding=True).to(model.device)
+
+    # Pad to the smallest bucket that fits so the compiled forward sees a bounded set of shapes
+    encoded = tokenizer(prompts)
+    if prompt_length is None:
+        longest = max(len(input_ids) for input_ids in encoded["input_ids"])
+        prompt_length = next(bucket for bucket in PROMPT_BUCKETS if bucket >= longest)
+
+    return tokenizer.pad(
+        encoded, padding="max_length", max_length=prompt_length, return_tensors="pt"
+    ).to(model.device)
+
+def count_generated_tokens(new_ids: torch.Tensor) -> int:
+    # Sequences that finish early are padded out with pad_token_id
+    return int((new_ids != eos_token_id).sum())
+
+def generate_batch(prompts: List[str], gen_args: dict, limits: List[int]) -> List[Tuple[str, int]]:
+    """Generate for a batch up to the largest limit, then trim each row to its own limit"""
+    if static_caches is not None:
+        # Pad to the preallocated cache's batch size; the extra rows are dropped below
+        prompts = prompts + [prompts[0]] * (MAX_BATCH_SIZE - len(prompts))
+
+    inputs = encode_prompts(prompts)
+    output_ids = run_generate(**inputs, **{**gen_args, "max_new_tokens": max(limits)})
+
+    # Slice off the prompt and count the generated ids instead of re-encoding the text
+    prompt_length = inputs["input_ids"].shape[1]
+    outputs = []
+    for new_ids, limit in zip(output_ids[:, prompt_length:], limits):
+        new_ids = new_ids[:limit]
+        text = tokenizer.decode(new_ids, skip_special_tokens=True)
+        outputs.append((text, count_generated_tokens(new_ids)))
+    return outputs
+
+async def batch_worker():
+    """Collect concurrent requests and run them through the model as one batch"""
+    loop = asyncio.get_running_loop()
+
+    while True:
+        batch = [await batch_queue.get()]
+        deadline = loop.time() + BATCH_WAIT_MS / 1000
+
+        while len(batch) < MAX_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(batch_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Sampling settings apply to the whole batch, so group requests by them;
+        # max_new_tokens is handled per row by generate_batch
+        groups = {}
+        for prompt, gen_args, future in batch:
+            if not future.done():
+                groups.setdefault(sampling_key(gen_args), []).append((prompt, gen_args, future))
+
+        for items in groups.values():
+            prompts = [prompt for prompt, _, _ in items]
+            limits = [gen_args["max_new_tokens"] for _, gen_args, _ in items]
+            try:
+                # Generation blocks on the GPU; keep the event loop free for other requests
+                outputs = await loop.run_in_executor(None, generate_batch, prompts, items[0][1], limits)
+            except Exception as e:
+                for _, _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, _, future), output in zip(items, outputs):
+                if not future.done():
+                    future.set_result(output)
+
+async def generate_with_transformers(request: GenerationRequest) -> Tuple[str, int]:
+    future = asyncio.get_running_loop().create_future()
+    await batch_queue.put((request.prompt, get_generation_args(request), future))
+    return await future
+
+def get_sampling_params(request: GenerationRequest):
+    from vllm import SamplingParams
+
+    # vLLM has no do_sample flag; temperature 0 selects greedy decoding
+    return SamplingParams(
+        temperature=request.temperature if request.do_sample else 0.0,
+        top_p=request.top_p if request.do_sample else 1.0,
+        max_tokens=request.max_new_tokens
+    )
+
+async def generate_with_vllm(request: GenerationRequest) -> Tuple[str, int]:
+    final_output = None
+    async for output in engine.generate(request.prompt, get_sampling_params(request), request_id=uuid4().hex):
+        final_output = output
+
+    completion = final_output.outputs[0]
+    return completion.text, len(completion.token_ids)
+
+class GenerationSlot:
+    """An admitted generation; frees its semaphore slot once every holder has released it"""
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.holders = 1
+
+    def hold(self):
+        self.holders += 1
+
+    def release(self):
+        self.holders -= 1
+        if self.holders == 0:
+            generation_semaphore.release()
+
+    def release_threadsafe(self):
+        # asyncio.Semaphore is not thread-safe, so release on the event loop
+        self.loop.call_soon_threadsafe(self.release)
+
+class StopOnEvent(StoppingCriteria):
+    """Stops generation once the event is set, e.g. when the client goes away"""
+
+    def __init__(self, event: threading.Event):
+        self.event = event
+
+    def __call__(self, input_ids: torch.Tensor, scores: torch.Tensor, **kwargs) -> torch.Tensor:
+        return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+async def stream_with_transformers(request: GenerationRequest, usage: dict,
+                                   slot: Optional[GenerationSlot] = None) -> AsyncIterator[str]:
+    loop = asyncio.get_running_loop()
+    inputs = encode_prompts([request.prompt])
+    streamer = TextIteratorStreamer(
+        tokenizer, skip_prompt=True, skip_special_tokens=True, timeout=STREAM_TOKEN_TIMEOUT
+    )
+    stop_event = threading.Event()
+    outcome = {}
+
+    def generate_in_thread():
+        try:
+            outcome["output_ids"] = run_generate(
+                **inputs,
+                **get_generation_args(request),
+                streamer=streamer,
+                stopping_criteria=StoppingCriteriaList([StopOnEvent(stop_event)])
+            )
+        except Exception as e:
+            outcome["error"] = e
+        finally:
+            # Unblock the consumer even when generate fails before finishing the stream
+            streamer.end()
+            if slot is not None:
+                slot.release_threadsafe()
+
+    # The slot stays taken until the GPU work has actually stopped
+    if slot is not None:
+        slot.hold()
+
+    # A streamer follows a single sequence, so streaming requests bypass the batch worker
+    threading.Thread(target=generate_in_thread, daemon=True).start()
+
+    try:
+        while True:
+            try:
+                piece = await loop.run_in_executor(None, next, streamer, None)
+            except queue.Empty:
+                raise TimeoutError(f"No tokens generated within {STREAM_TOKEN_TIMEOUT:.0f}s")
+            if piece is None:
+                break
+            if piece:
+                yield piece
+    finally:
+        # Stop decoding when the client disconnects or the stream times out
+        stop_event.set()
+
+    if "error" in outcome:
+        raise outcome["error"]
+
+    prompt_length = inputs["input_ids"].shape[1]
+    usage["tokens_generated"] = count_generated_tokens(outcome["output_ids"][0, prompt_length:])
+
+async def stream_with_vllm(request: GenerationRequest, usage: dict) -> AsyncIterator[str]:
+    # vLLM reports the full completion so far; emit only the new suffix
+    sent = 0
+    async for output in engine.generate(request.prompt, get_sampling_params(request), request_id=uuid4().hex):
+        completion = output.outputs[0]
+        usage["tokens_generated"] = len(completion.token_ids)
+        text = completion.text
+        if len(text) > sent:
+            yield text[sent:]
+            sent = len(text)
+
+def sse_event(data: dict) -> str:
+    return f"data: {json.dumps(data)}\n\n"
+
+async def stream_generation(request: GenerationRequest, cache_key: str, cached: Optional[dict],
+                            start: float, slot: Optional[GenerationSlot] = None) -> AsyncIterator[str]:
+    if cached:
+        yield sse_event({"token": cached["generated_text"]})
+        yield sse_event({
+            "done": True,
+            "cached": True,
+            "tokens_generated": cached["tokens_generated"],
+            "processing_time": time.time() - start
+        })
+        return
+
+    pieces = []
+    # Filled in by the backend stream with the exact generated token count
+    usage = {"tokens_generated": 0}
+    try:
+        if INFERENCE_BACKEND == "vllm":
+            stream = stream_with_vllm(request, usage)
+        else:
+            stream = stream_with_transformers(request, usage, slot)
+
+        async for piece in stream:
+            pieces.append(piece)
+            yield sse_event({"token": piece})
+    except Exception as e:
+        logger.error(f"Streaming generation error: {e}")
+        yield sse_event({"error": f"Generation failed: {str(e)}"})
+        return
+
+    text = "".join(pieces)
+    tokens = usage["tokens_generated"]
+    response = {
+        "prompt": request.prompt,
+        "generated_text": text,
+        "processing_time": time.time() - start,
+        "device_used": DEVICE,
+        "cached": False,
+        "tokens_generated": tokens
+    }
+
+    schedule_cache_write(cache_key, response)
+    logger.info(f"Streamed {tokens} tokens in {response['processing_time']:.2f}s")
+    yield sse_event({
+        "done": True,
+        "cached": False,
+        "tokens_generated": tokens,
+        "processing_time": response["processing_time"]
+    })
+
+async def acquire_generation_slot() -> Optional[GenerationSlot]:
+    """Admit a generation or reject it with 429 once MAX_CONCURRENCY are in flight"""
+    if generation_semaphore is None:
+        return None
+
+    try:
+        await asyncio.wait_for(generation_semaphore.acquire(), timeout=ADMISSION_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(
+            status_code=429,
+            detail="Too many concurrent generations",
+            headers={"Retry-After": "1"}
+        )
+    return GenerationSlot()
+
+class SlotStreamingResponse(StreamingResponse):
+    """Streaming response that gives up its hold on the generation slot however the response ends"""
+
+    def __init__(self, *args, slot: Optional[GenerationSlot] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.slot = slot
+
+    async def __call__(self, scope, receive, send):
+        # Released here rather than in the body iterator, which never starts if the
+        # client disconnects before streaming begins. A running generate thread holds
+        # the slot separately until it stops.
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if self.slot is not None:
+                self.slot.release()
+
+def get_cache_key(request: GenerationRequest) -> str:
+    cache_data = (
+        f"{request.prompt}|{request.max_new_tokens}|{request.temperature:.3f}"
+        f"|{request.top_p:.3f}|{int(request.do_sample)}"
+    )
+    return f"llm:{xxhash.xxh3_128_hexdigest(cache_data)}"
+
+async def initialize_cache():
+    global redis_client
+
+    try:
+        redis_url = os.getenv('CACHE_URL')
+        if redis_url:
+            client = redis.from_url(redis_url, decode_responses=False, max_connections=32)
+            await client.ping()
+            redis_client = client
+            logger.info("Redis cache connected")
+    except Exception as e:
+        logger.warning(f"Redis not available: {e}")
+
+async def cache_response(key: str, response: dict, ttl: int = CACHE_TTL):
+    local_cache[key] = response
 
-def cache_response(key: str, response: dict, ttl: int = 3600):
     if redis_client:
         try:
-            redis_client.setex(key, ttl, json.dumps(response))
+            await redis_client.setex(key, ttl, cache_encoder.encode(response))
         except Exception as e:
             logger.warning(f"Cache write failed: {e}")
 
-def get_cached_response(key: str) -> Optional[dict]:
+def schedule_cache_write(key: str, response: dict):
+    """Write to the cache without delaying the response"""
+    task = asyncio.create_task(cache_response(key, response, CACHE_TTL))
+    cache_write_tasks.add(task)
+    task.add_done_callback(cache_write_tasks.discard)
+
+async def get_cached_response(key: str) -> Optional[dict]:
+    cached = local_cache.get(key)
+    if cached:
+        # Callers update the returned dict, so hand out a copy
+        return dict(cached)
+
     if redis_client:
         try:
-            cached = redis_client.get(key)
+            cached = await redis_client.get(key)
             if cached:
-                return json.loads(cached)
+                response = cache_decoder.decode(cached)
+                local_cache[key] = response
+                return dict(response)
         except Exception as e:
             logger.warning(f"Cache read failed: {e}")
     return None
 
 @app.on_event("startup")
 async def startup_event():
-    initialize_model()
+    global batch_queue, batch_worker_task, generation_semaphore
+
+    await initialize_cache()
+
+    if INFERENCE_BACKEND == "vllm":
+        initialize_vllm_engine()
+    else:
+        initialize_model()
+        batch_queue = asyncio.Queue()
+        batch_worker_task = asyncio.create_task(batch_worker())
+        # vLLM schedules and preempts sequences against its own KV cache budget, so
+        # admission control only applies to the transformers backend
+        generation_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+@cached(TTLCache(maxsize=1, ttl=1.0))
+def get_gpu_stats() -> dict:
+    """GPU memory usage, cached briefly so frequent health probes don't query CUDA each time"""
+    return {
+        "memory_allocated_gb": torch.cuda.memory_allocated(0) / 1024**3,
+        "memory_reserved_gb": torch.cuda.memory_reserved(0) / 1024**3
+    }
 
 @app.get("/health")
 async def health_check():
@@ -144,16 +694,18 @@ async def health_check():
         "status": "healthy",
         "model": MODEL_NAME,
         "device": DEVICE,
-        "gpu_available": torch.cuda.is_available(),
-        "model_loaded": model is not None,
+        "backend": INFERENCE_BACKEND,
+        "gpu_available": DEVICE == "cuda",
+        "model_loaded": model_ready(),
         "cache_available": redis_client is not None
     }
 
-    if torch.cuda.is_available():
+    if DEVICE == "cuda":
+        gpu_stats = get_gpu_stats()
         health.update({
-            "gpu_name": torch.cuda.get_device_name(0),
-            "gpu_memory_allocated": f"{torch.cuda.memory_allocated(0) / 1024**3:.2f}GB",
-            "gpu_memory_reserved": f"{torch.cuda.memory_reserved(0) / 1024**3:.2f}GB"
+            "gpu_name": GPU_NAME,
+            "gpu_memory_allocated": f"{gpu_stats['memory_allocated_gb']:.2f}GB",
+            "gpu_memory_reserved": f"{gpu_stats['memory_reserved_gb']:.2f}GB"
         })
 
     return health
@@ -180,49 +732,60 @@ async def metrics():
         "requests_cached": 0
     }
 
-    if torch.cuda.is_available():
+    if DEVICE == "cuda":
         data.update({
-            "gpu_memory_used": f"{torch.cuda.memory_allocated(0) / 1024**3:.2f}GB",
+            "gpu_memory_used": f"{get_gpu_stats()['memory_allocated_gb']:.2f}GB",
             "gpu_temperature": "N/A"
         })
 
     return data
 
 @app.post("/generate", response_model=GenerationResponse)
-async def generate_text(request: GenerationRequest, background_tasks: BackgroundTasks):
+async def generate_text(request: GenerationRequest):
     start = time.time()
 
-    if model is None or tokenizer is None:
+    if not model_ready():
         raise HTTPException(status_code=503, detail="Model not loaded")
 
-    cache_params = {
-        "max_new_tokens": request.max_new_tokens,
-        "temperature": request.temperature,
-        "top_p": request.top_p,
-        "do_sample": request.do_sample
-    }
-    cache_key = get_cache_key(request.prompt, cache_params)
+    # Prompts longer than the preallocated cache are rejected rather than truncated
+    if static_caches is not None and len(tokenizer(request.prompt)["input_ids"]) > MAX_PROMPT_TOKENS:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Prompt exceeds {MAX_PROMPT_TOKENS} tokens"
+        )
+
+    cache_key = get_cache_key(request)
+
+    cached = await get_cached_response(cache_key)
+
+    if request.stream:
+        if cached:
+            return StreamingResponse(
+                stream_generation(request, cache_key, cached, start),
+                media_type="text/event-stream"
+            )
+
+        slot = await acquire_generation_slot()
+        return SlotStreamingResponse(
+            stream_generation(request, cache_key, None, start, slot),
+            media_type="text/event-stream",
+            slot=slot
+        )
 
-    cached = get_cached_response(cache_key)
     if cached:
         logger.info("Serving from cache")
         cached["processing_time"] = time.time() - start
         cached["cached"] = True
-        return GenerationResponse(**cached)
+        # response_model validates the dict once; building the model here would do it twice
+        return cached
 
-    try:
-        gen_args = {
-            "max_new_tokens": request.max_new_tokens,
-            "temperature": request.temperature,
-            "top_p": request.top_p,
-            "do_sample": request.do_sample,
-            "pad_token_id": tokenizer.eos_token_id,
-            "return_full_text": False
-        }
+    slot = await acquire_generation_slot()
 
-        result = text_generator(request.prompt, **gen_args)[0]
-        text = result["generated_text"]
-        tokens = len(tokenizer.encode(text))
+    try:
+        if INFERENCE_BACKEND == "vllm":
+            text, tokens = await generate_with_vllm(request)
+        else:
+            text, tokens = await generate_with_transformers(request)
 
         response = {
             "prompt": request.prompt,
@@ -233,9 +796,9 @@ async def generate_text(request: GenerationRequest, background_tasks: Background
             "tokens_generated": tokens
         }
 
-        background_tasks.add_task(cache_response, cache_key, response, 3600)
+        schedule_cache_write(cache_key, response)
         logger.info(f"Generated {tokens} tokens in {response['processing_time']:.2f}s")
-        return GenerationResponse(**response)
+        return response
 
     except Exception as e:
         logger.error(f"Generation error: {e}")
@@ -243,6 +806,11 @@ async def generate_text(request: GenerationRequest, background_tasks: Background
             raise HTTPException(status_code=507, detail="GPU memory insufficient")
         raise HTTPException(status_code=500, detail=f"Generation failed: {str(e)}")
 
+    finally:
+        if slot is not None:
+            slot.release()
+
 if __name__ == "__main__":
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # The model is a per-process singleton on the GPU, so run a single worker
+    uvicorn.run(app, host="0.0.0.0", port=port, loop="uvloop", http="httptools", workers=1)
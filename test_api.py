@@ -149,6 +149,49 @@ def test_api(base_url):
     except Exception as e:
         print(f"   ❌ Cache test error: {e}")
     
+    # Test streaming
+    print("\n6. Testing streaming generation...")
+    stream_test = {
+        "prompt": "Tell me a story about a robot",
+        "max_new_tokens": 30,
+        "temperature": 0.7,
+        "stream": True
+    }
+    
+    try:
+        start_time = time.time()
+        first_token_time = None
+        summary = None
+        with requests.post(
+            f"{base_url}/generate",
+            json=stream_test,
+            headers={"Content-Type": "application/json"},
+            stream=True,
+            timeout=60
+        ) as response:
+            if response.status_code == 200:
+                for line in response.iter_lines(decode_unicode=True):
+                    if not line or not line.startswith("data: "):
+                        continue
+                    event = json.loads(line[len("data: "):])
+                    if "token" in event and first_token_time is None:
+                        first_token_time = time.time() - start_time
+                    if event.get("done") or "error" in event:
+                        summary = event
+                
+                if summary and summary.get("done"):
+                    print(f"   ✅ Streaming successful ({time.time() - start_time:.2f}s)")
+                    if first_token_time is not None:
+                        print(f"   ⚡ Time to first token: {first_token_time:.2f}s")
+                    print(f"   🎯 Tokens: {summary.get('tokens_generated')}")
+                else:
+                    print(f"   ❌ Streaming failed: {summary}")
+            else:
+                print(f"   ❌ Streaming request failed: {response.status_code}")
+    
+    except Exception as e:
+        print(f"   ❌ Streaming test error: {e}")
+    
     print("\n🎉 API testing completed!")
     return True
 